@@ -0,0 +1,86 @@
+import os
+import random
+import pytest
+from ugit import data, base, diff
+
+@pytest.fixture
+def repo(tmp_path):
+    root = tmp_path / 'repo'
+    root.mkdir()
+    repo = data.Repository(str(root))
+    with data.use_repository(repo):
+        base.init()
+        yield repo
+
+def _write(root, path, content):
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+def _snapshot(root):
+    """
+    Return {path: content} of files and the set of directories under root, ignoring .ugit
+    """
+    files, dirs = {}, set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if name != '.ugit']
+        dirs.update(os.path.relpath(os.path.join(dirpath, name), root) for name in dirnames)
+        for name in filenames:
+            with open(os.path.join(dirpath, name), 'rb') as f:
+                files[os.path.relpath(os.path.join(dirpath, name), root)] = f.read()
+    return files, dirs
+
+def _serial_write(root, files):
+    """
+    Write {path: content} one by one, as read_tree did before files were written in parallel
+    """
+    for path, content in files.items():
+        os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(root, path), 'wb') as f:
+            f.write(content)
+
+def _make_history(repo):
+    rng = random.Random(0)
+    paths = [f'd{i % 3}/e{i % 5}/f{i}.txt' for i in range(base.WRITE_MAX_IN_FLIGHT * 3)]
+    for path in paths:
+        _write(repo.root, path, f'line 1\nline 2 of {path}\nline 3\n'.encode())
+    _write(repo.root, 'd0/model.bin', rng.randbytes(2 * 1024 * 1024)) # stored as a chunked blob
+    c_base = base.commit('base')
+    base.create_branch('other', c_base)
+    for path in paths[::2]:
+        _write(repo.root, path, f'line 1 changed in HEAD\nline 2 of {path}\nline 3\n'.encode())
+    os.remove(os.path.join(repo.root, paths[1]))
+    c_HEAD = base.commit('HEAD')
+    base.checkout('other')
+    for path in paths[::3]:
+        _write(repo.root, path, f'line 1\nline 2 of {path}\nline 3 changed in other\n'.encode())
+    _write(repo.root, 'new/only_in_other.txt', b'other\n')
+    c_other = base.commit('other')
+    return base.get_commit(c_base), base.get_commit(c_HEAD), base.get_commit(c_other)
+
+def test_read_tree_matches_serial(repo, tmp_path):
+    c_base, c_HEAD, c_other = _make_history(repo)
+    assert data.get_object_type(base.get_tree(c_base.tree)['d0/model.bin']) == 'chunked'
+    for tree in (c_base.tree, c_HEAD.tree, c_other.tree):
+        base.read_tree(tree)
+        expected = str(tmp_path / f'expected_{tree}')
+        _serial_write(expected, {path: data.get_object(oid) for path, oid in base.get_tree(tree).items()})
+        assert _snapshot(repo.root) == _snapshot(expected)
+
+def test_read_tree_merged_matches_serial(repo, tmp_path):
+    c_base, c_HEAD, c_other = _make_history(repo)
+    base.checkout('master')
+    base.read_tree_merged(c_base.tree, c_HEAD.tree, c_other.tree)
+    expected = str(tmp_path / 'expected')
+    _serial_write(expected, diff.merge_trees(
+        base.get_tree(c_base.tree), base.get_tree(c_HEAD.tree), base.get_tree(c_other.tree)))
+    assert _snapshot(repo.root) == _snapshot(expected)
+
+def test_read_tree_raises_worker_error(repo):
+    c_base, _, _ = _make_history(repo)
+    oid = base.get_tree(c_base.tree)['d1/e1/f1.txt']
+    os.remove(os.path.join(repo.objects_dir, oid[:2], oid[2:]))
+    repo.refresh() # drop the object from the cache
+    with pytest.raises(FileNotFoundError):
+        base.read_tree(c_base.tree)
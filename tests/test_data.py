@@ -0,0 +1,120 @@
+import hashlib
+import random
+import pytest
+from ugit import data
+
+@pytest.fixture
+def repo(tmp_path):
+    repo = data.Repository(str(tmp_path))
+    repo.init()
+    return repo
+
+def _random_bytes(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+def _text_bytes(size, seed=0):
+    # csv-like data, which has few distinct bytes
+    rng = random.Random(seed)
+    text = ''.join(f'{i},{rng.random():.6f},item{rng.randint(0, 999)},{"abc"[i % 3]}\n' for i in range(size // 20))
+    return text.encode()[:size]
+
+def test_small_blob_oid_unchanged(repo):
+    # oid of a small blob is sha1 of its content, as before chunking
+    assert repo.hash_object(b'hello') == 'aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d'
+    assert repo.get_object('aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d', 'blob') == b'hello'
+
+def test_large_blob_oid_unchanged(repo):
+    blob = _random_bytes(2 * 1024 * 1024)
+    oid = repo.hash_object(blob)
+    assert oid == hashlib.sha1(blob).hexdigest()
+    assert repo.get_object_type(oid) == 'chunked'
+    assert repo.get_object(oid) == blob
+
+def test_blob_stored_before_chunking_keeps_oid(repo, monkeypatch):
+    blob = _random_bytes(2 * 1024 * 1024)
+    monkeypatch.setattr(data, 'CHUNK_THRESHOLD', None)
+    oid = repo.hash_object(blob)
+    monkeypatch.undo()
+    assert repo.hash_object(blob) == oid
+    assert repo.get_object_type(oid) == 'blob'
+    assert repo.get_object(oid) == blob
+
+def test_chunk_boundaries_are_pinned():
+    # boundaries must never change, otherwise new revisions stop sharing chunks with old ones
+    for blob, expected in ((_random_bytes(2 * 1024 * 1024), [62283, 103314, 137316, 171891]),
+                           (_text_bytes(2 * 1024 * 1024), [82013, 156297, 228348, 256499])):
+        chunks = list(data._iter_chunks(blob))
+        offsets = [sum(len(chunk) for chunk in chunks[:i + 1]) for i in range(4)]
+        assert offsets == expected
+        assert b''.join(chunks) == blob
+        assert all(len(chunk) <= data.CHUNK_MAX_SIZE for chunk in chunks)
+
+@pytest.mark.parametrize('make_blob', [_random_bytes, _text_bytes, lambda size: bytes(size)])
+@pytest.mark.parametrize('edit', [
+    lambda blob, i: blob[:i] + bytes([blob[i] ^ 1]) + blob[i + 1:], # modify one byte
+    lambda blob, i: blob[:i] + b'x' + blob[i:], # insert one byte
+    lambda blob, i: blob[:i] + blob[i + 1:], # delete one byte
+])
+@pytest.mark.parametrize('position', [0, 4 * 1024 * 1024])
+def test_one_byte_edit_changes_few_chunks(repo, make_blob, edit, position):
+    blob = make_blob(8 * 1024 * 1024)
+    edited = edit(blob, position)
+    oid, edited_oid = repo.hash_object(blob), repo.hash_object(edited)
+    chunks = repo.get_object(oid, 'chunked').split()
+    edited_chunks = repo.get_object(edited_oid, 'chunked').split()
+    assert len(set(edited_chunks) - set(chunks)) in (1, 2)
+    assert repo.get_object(oid) == blob
+    assert repo.get_object(edited_oid) == edited
+
+def test_file_equal_to_manifest_does_not_replace_it(repo):
+    blob = _random_bytes(2 * 1024 * 1024)
+    oid = repo.hash_object(blob)
+    manifest = repo.get_object(oid, 'chunked')
+    # e.g. the manifest text, or an object file copied into the working tree
+    for content in (manifest, b'chunked\x00' + manifest):
+        small_oid = repo.hash_object(content)
+        assert small_oid != oid
+        assert repo.get_object(small_oid) == content
+    assert repo.get_object(oid) == blob
+
+def test_default_repository_follows_current_directory(tmp_path, monkeypatch):
+    from ugit import base
+    for name in ('r1', 'r2'):
+        (tmp_path / name).mkdir()
+        monkeypatch.chdir(tmp_path / name)
+        base.init()
+        (tmp_path / name / 'f').write_text(name)
+        oid = base.commit(name)
+        assert data.get_ref('refs/heads/master').value == oid
+        assert base.get_commit(oid).parents == []
+
+def test_rewrite_object_while_reading(repo):
+    import threading
+    blob = _random_bytes(4096)
+    oid = repo.hash_object(blob)
+    stop = threading.Event()
+    def rewrite():
+        while not stop.is_set():
+            repo.hash_object(blob)
+    writer = threading.Thread(target=rewrite)
+    writer.start()
+    try:
+        for _ in range(2000):
+            repo.refresh()
+            assert repo.get_object(oid) == blob
+    finally:
+        stop.set()
+        writer.join()
+
+def test_ref_updated_by_other_process(repo):
+    repo.update_ref('refs/heads/master', data.RefValue(symbolic=False, value='a' * 40))
+    assert repo.get_ref('refs/heads/master').value == 'a' * 40
+    # simulate another process, e.g. the cli, moving the branch
+    other = data.Repository(repo.root)
+    other.update_ref('refs/heads/master', data.RefValue(symbolic=False, value='b' * 40))
+    assert repo.get_ref('refs/heads/master').value == 'b' * 40
+
+def test_open_repository_is_shared(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert data.open_repository('.') is data.open_repository(str(tmp_path))
+    assert data.open_repository('.').root == str(tmp_path)
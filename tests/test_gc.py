@@ -0,0 +1,86 @@
+import os
+import random
+import pytest
+from ugit import data, base
+
+@pytest.fixture
+def repo(tmp_path):
+    repo = data.Repository(str(tmp_path))
+    with data.use_repository(repo):
+        base.init()
+        yield repo
+
+def _age_objects(repo, seconds):
+    for oid, stat in repo.iter_objects():
+        path = os.path.join(repo.objects_dir, oid[:2], oid[2:])
+        os.utime(path, (stat.st_atime - seconds, stat.st_mtime - seconds))
+
+def _object_size(repo, oid):
+    return os.path.getsize(os.path.join(repo.objects_dir, oid[:2], oid[2:]))
+
+def test_gc_prune(repo):
+    big = random.Random(0).randbytes(2 * 1024 * 1024)
+    with open(os.path.join(repo.root, 'big'), 'wb') as f:
+        f.write(big)
+    with open(os.path.join(repo.root, 'small'), 'w') as f:
+        f.write('one')
+    first = base.commit('first')
+    with open(os.path.join(repo.root, 'small'), 'w') as f:
+        f.write('two')
+    second = base.commit('second')
+    base.reset(first) # second commit, its tree and the 'two' blob are unreachable now
+    stray = data.hash_object(b'stray')
+    garbage = {second, base.get_commit(second).tree, base.get_working_tree()['small'], stray}
+    _age_objects(repo, base.GC_EXPIRE + 60)
+    young = data.hash_object(b'young') # unreachable but within the grace period
+
+    objects = {oid for oid, _ in repo.iter_objects()}
+    size = sum(_object_size(repo, oid) for oid in garbage)
+    assert base.gc(prune=False) == (len(garbage), size)
+    assert {oid for oid, _ in repo.iter_objects()} == objects
+
+    assert base.gc(prune=True) == (len(garbage), size)
+    assert {oid for oid, _ in repo.iter_objects()} == objects - garbage
+    assert young in objects - garbage
+    # chunks of the big file are still there
+    big_oid = base.get_tree(base.get_commit(first).tree)['big']
+    assert len(data.get_object(big_oid, 'chunked').split()) > 1
+    assert data.get_object(big_oid) == big
+    assert base.gc(prune=True) == (0, 0)
+    # object directories are kept, so writing a pruned object again works
+    assert data.hash_object(b'stray') == stray
+
+def test_gc_rejects_negative_expire(repo):
+    with pytest.raises(ValueError):
+        base.gc(expire=-1)
+
+def test_gc_prune_while_other_repository_writes(repo):
+    # e.g. a server keeps the repository warm while 'ugit gc --prune' runs from the cli
+    other = data.Repository(repo.root)
+    stray = other.hash_object(b'stray')
+    _age_objects(repo, base.GC_EXPIRE + 60)
+    assert base.gc(prune=True)[0] == 1
+    assert other.hash_object(b'stray') == stray
+    assert other.get_object(stray) == b'stray'
+
+def test_gc_keeps_object_hashed_again_while_running(repo, monkeypatch):
+    path = os.path.join(repo.root, 'f')
+    with open(path, 'w') as f:
+        f.write('one')
+    first = base.commit('first')
+    with open(path, 'w') as f:
+        f.write('two')
+    second = base.commit('second')
+    base.reset(first)
+    _age_objects(repo, base.GC_EXPIRE + 60)
+
+    iter_objects = data.iter_objects
+    def iter_objects_then_commit():
+        # objects are listed, then a commit of the old content runs before they are deleted
+        yield from list(iter_objects())
+        assert base.commit('second') == second
+    monkeypatch.setattr(data, 'iter_objects', iter_objects_then_commit)
+    assert base.gc(prune=True) == (0, 0)
+    monkeypatch.undo()
+
+    assert base.get_tree(base.get_commit(data.get_ref('HEAD').value).tree) == {'f': data.hash_object(b'two')}
@@ -3,11 +3,19 @@ import itertools
 import operator
 from collections import deque, namedtuple
 import string
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
 from . import data
 from . import diff
 
 Commit = namedtuple('Commit', ['tree', 'parents', 'message']) # tree = Commit.tree
 
+WRITE_WORKERS = 8 # number of threads reading objects and writing files
+WRITE_MAX_IN_FLIGHT = 64 # at most this many files are held in memory at the same time
+GC_WORKERS = 8 # number of threads walking trees in gc
+GC_EXPIRE = 14 * 24 * 3600 # unreachable objects younger than this (in seconds) are kept by gc
+
 def init():
     """
     Set HEAD point to master
@@ -20,28 +28,31 @@ def get_working_tree():
     Scan each file in working directory; hash the directory without actually writing a tree object
     """
     result = {}
-    for root, dirnames, filenames in os.walk('.', topdown=False):
+    work_dir = data.get_repository().root
+    for root, dirnames, filenames in os.walk(work_dir, topdown=False):
         for filename in filenames:
-            path = os.path.relpath(os.path.join(root, filename))
-            if is_ignored(path) or not os.path.isfile(path):
+            path = os.path.relpath(os.path.join(root, filename), work_dir)
+            if is_ignored(path) or not os.path.isfile(os.path.join(work_dir, path)):
                 continue
-            with open(path, 'rb') as f:
+            with open(os.path.join(work_dir, path), 'rb') as f:
                 result[path] = data.hash_object(f.read())
     return result
 
 def write_tree(directory='.'):
     """
     Scan and hash each file in directory; hash the directory and all subdirectories to ugit objects.
+    Note: directory is relative to the working directory of the repository.
     """
     entries = []
-    with os.scandir(directory) as it:
+    work_dir = data.get_repository().root
+    with os.scandir(os.path.join(work_dir, directory)) as it:
         for entry in it:
             full_path = os.path.join(directory, entry.name)
             if is_ignored(full_path):
                 continue
             if entry.is_file() and not entry.is_symlink():
                 obj_type = 'blob'
-                with open(full_path, 'rb') as f:
+                with open(entry.path, 'rb') as f:
                     oid = data.hash_object(f.read())
             elif entry.is_dir() and not entry.is_symlink():
                 # recursively scan this directory
@@ -83,30 +94,60 @@ def _empty_current_directory():
     """
     Delete all files uder current directory.
     """
-    for root, dirnames, filenames in os.walk('.', topdown=False):
+    work_dir = data.get_repository().root
+    for root, dirnames, filenames in os.walk(work_dir, topdown=False):
         for filename in filenames:
-            path = os.path.relpath(os.path.join(root, filename))
-            if is_ignored(path) or not os.path.isfile(path):
+            path = os.path.join(root, filename)
+            if is_ignored(os.path.relpath(path, work_dir)) or not os.path.isfile(path):
                 continue
             os.remove(path)
         for dirname in dirnames:
-            path = os.path.relpath(os.path.join(root, dirname))
-            if is_ignored(path):
+            path = os.path.join(root, dirname)
+            if is_ignored(os.path.relpath(path, work_dir)):
                 continue
             if len(os.listdir(path)) == 0:
                 # do not delete if the directory contains ignored files
                 os.rmdir(path)
 
+def _write_file(repository, path, load):
+    """
+    Load file content from repository and write it to path.
+    """
+    with data.use_repository(repository):
+        content = load()
+    with open(path, 'wb') as f:
+        f.write(content)
+
+def _write_files(files):
+    """
+    Write files to working directory in parallel. files: iterable of (path, load), load() returns the file content.
+    """
+    files = list(files)
+    repository = data.get_repository() # worker threads do not inherit the repository of this thread
+    # create all directories up front in one pass, so workers only write files
+    for dirname in sorted({os.path.dirname(path) for path, _ in files}):
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as executor:
+        pending = set()
+        for path, load in files:
+            if len(pending) >= WRITE_MAX_IN_FLIGHT:
+                # wait for some files to be written to bound memory usage
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result() # raise exception in worker if any
+            pending.add(executor.submit(_write_file, repository, path, load))
+        for future in pending:
+            future.result()
+
 def read_tree(tree_oid):
     """
     Retrive working directory committed in tree_oid.
     Note: read_tree will lose all uncommitted changes.
     """
     _empty_current_directory()
-    for path, oid in get_tree(tree_oid, base_path='./').items():
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb') as f:
-            f.write(data.get_object(oid))
+    _write_files((path, partial(data.get_object, oid))
+                 for path, oid in get_tree(tree_oid, base_path=data.get_repository().root).items())
 
 def read_tree_merged(t_base, t_HEAD, t_other):
     """
@@ -114,10 +155,10 @@ def read_tree_merged(t_base, t_HEAD, t_other):
     Note: this is a three-way merge. t_HEAD and t_other are merged based on their common ancestor, t_base.
     """
     _empty_current_directory()
-    for path, blob in diff.merge_trees(get_tree(t_base), get_tree(t_HEAD), get_tree(t_other)).items():
-        os.makedirs(f'./{os.path.dirname(path)}', exist_ok=True)
-        with open(path, 'wb') as f:
-            f.write(blob)
+    work_dir = data.get_repository().root
+    # each file is merged in the worker which writes it
+    _write_files((os.path.join(work_dir, path), partial(diff.merge_blobs, o_base, o_HEAD, o_other))
+                 for path, o_base, o_HEAD, o_other in diff.compare_trees(get_tree(t_base), get_tree(t_HEAD), get_tree(t_other)))
 
 def is_ignored(path):
     """
@@ -277,4 +318,59 @@ def get_merge_base(oid1, oid2):
     # iterate over all parents of the oid1 until we find a parent that is a parent of oid2
     for oid in iter_commits_and_parents({oid2}):
         if oid in parents1:
-            return oid
\ No newline at end of file
+            return oid
+
+def _iter_children(repository, oid, obj_type):
+    """
+    Return (oid, type) of objects referred by a tree or chunked blob.
+    """
+    with data.use_repository(repository):
+        if obj_type == 'tree':
+            return [(child, child_type) for child_type, child, _ in _iter_tree_entries(oid)]
+        if data.get_object_type(oid) == 'chunked':
+            return [(chunk, 'blob') for chunk in data.get_object(oid, 'chunked').decode().split()]
+        return []
+
+def get_reachable_objects():
+    """
+    Return oids of all objects reachable from refs: commits, trees, blobs and chunks.
+    Note: trees are walked level by level, objects of each level are read in parallel.
+    """
+    oids = {ref.value for _, ref in data.iter_refs(deref=False) if not ref.symbolic}
+    reachable = set(iter_commits_and_parents(oids))
+    level = {(get_commit(oid).tree, 'tree') for oid in reachable}
+    repository = data.get_repository() # worker threads do not inherit the repository of this thread
+    with ThreadPoolExecutor(max_workers=GC_WORKERS) as executor:
+        while level:
+            reachable.update(oid for oid, _ in level)
+            children = executor.map(lambda entry: _iter_children(repository, *entry), level)
+            level = {child for entries in children for child in entries if child[0] not in reachable}
+    return reachable
+
+def gc(prune=False, expire=GC_EXPIRE):
+    """
+    Find unreachable objects older than expire seconds, delete them if prune is True.
+    Return number of objects and bytes found.
+    Note: recent objects are kept because they may belong to a commit or working tree scan in progress.
+    Hashing an object again refreshes its mtime, which is checked again right before it is deleted.
+    gc does not lock against writers, so an expire shorter than the longest running commit is unsafe:
+    objects hashed by that commit but not yet referenced by a ref would be deleted.
+    """
+    if expire < 0:
+        raise ValueError('expire must not be negative: {0}'.format(expire))
+    reachable = get_reachable_objects()
+    deadline = time.time() - expire
+    count = size = 0
+    for oid, stat in list(data.iter_objects()):
+        if oid in reachable or stat.st_mtime > deadline:
+            continue
+        if prune:
+            # the object may have been hashed again since it was listed, delete_object checks mtime again
+            object_size = data.delete_object(oid, deadline)
+            if object_size is None:
+                continue
+        else:
+            object_size = stat.st_size
+        count += 1
+        size += object_size
+    return count, size
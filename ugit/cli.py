@@ -85,6 +85,11 @@ def parse_args():
     merge_base_parser.add_argument('commit1', type=oid)
     merge_base_parser.add_argument('commit2', type=oid)
 
+    gc_parser = commands.add_parser('gc')
+    gc_parser.set_defaults(func=gc)
+    gc_parser.add_argument('--prune', action='store_true') # without --prune, only report unreachable objects
+    gc_parser.add_argument('--expire', default=base.GC_EXPIRE, type=int) # in seconds, must be longer than any running commit
+
     return parser.parse_args()
 
 def init(args):
@@ -212,6 +217,14 @@ def merge_base(args):
     # find the first common ancestor of two commits
     print(base.get_merge_base(args.commit1, args.commit2))
 
+def gc(args):
+    # delete objects not reachable from any ref
+    count, size = base.gc(prune=args.prune, expire=args.expire)
+    if args.prune:
+        print('Pruned {0} objects, {1} bytes reclaimed'.format(count, size))
+    else:
+        print('{0} unreachable objects, {1} bytes (use --prune to delete them)'.format(count, size))
+
 def k(args):
     # visualize branchs, as gitk
     dot = 'digraph commits {\n'
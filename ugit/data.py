@@ -1,113 +1,419 @@
 import os
+import re
+import zlib
 import hashlib
-from collections import namedtuple
+import itertools
+import stat
+import threading
+import uuid
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 
 GIT_DIR = '.ugit'
 
 RefValue = namedtuple('RefValue', ['symbolic', 'value'])
 
-def init():
-    """
-    Init .ugit repository
-    """
-    if os.path.exists(GIT_DIR):
-        # we do not really reinitialize git repository here
-        print('Reinitialized existing Git repository in %s' % os.path.join(os.getcwd(), GIT_DIR))
-    else:
-        os.makedirs(GIT_DIR)
-        os.makedirs(os.path.join(os.getcwd(), GIT_DIR, 'objects'))
-        print('Initialized empty ugit repository in %s' % os.path.join(os.getcwd(), GIT_DIR))
+OBJECT_CACHE_SIZE = 32 * 1024 * 1024 # max bytes of objects kept in memory by a repository
+OBJECT_CACHE_MAX_ITEM = 64 * 1024 # larger objects (mostly blobs) are never cached
 
-def update_ref(ref, value, deref=True):
+# blobs larger than CHUNK_THRESHOLD are split into chunks by content; set it to None to disable chunking
+CHUNK_THRESHOLD = 1024 * 1024
+CHUNK_MIN_SIZE = 16 * 1024
+CHUNK_MAX_SIZE = 256 * 1024
+CHUNK_WINDOW = 48 # number of bytes before a candidate boundary which decide whether to cut there
+CHUNK_MASK = 0xFF # 1 in 256 candidates is cut -> average chunk size is about CHUNK_MIN_SIZE + 64KB
+_CHUNK_BLOCK = 1024 * 1024 # rolling hash is computed for this many bytes at a time to bound memory
+# random but fixed table for the rolling hash, chunk boundaries must not change between runs
+_CHUNK_TABLE = bytes(hashlib.sha1(bytes([i])).digest()[0] for i in range(256))
+_CHUNK_RUN = re.compile(rb'(.)\1*', re.DOTALL)
+
+class Repository:
     """
-    Create or update a ref in .ugit/<ref>
+    A ugit repository whose working directory is root.
+    It keeps the ref table and recently read objects in memory, so it can be reused across operations and threads.
+    If root is None, the repository is the current directory of each call and nothing is cached.
+    Note: no file handles are kept open, objects are read once by path and hundreds of open repositories would exhaust file descriptors.
     """
-    # dereference ref if ref is a symbolic ref, we only update the real ref 
-    ref = _get_ref_internal(ref, deref)[0] 
-    if not value.value:
-        raise TypeError('RefValue is empty: "{0}"'.format(value))
-    if value.symbolic:
-        # set value of a symbolic ref as 'ref: <pointed ref>'
-        value = 'ref: {0}'.format(value.value)
-    else:
-        value = value.value
-
-    ref_path = os.path.join(GIT_DIR, ref)
-    os.makedirs(os.path.dirname(ref_path), exist_ok=True)
-    with open(ref_path, 'w') as f:
-        f.write(value)
+    def __init__(self, root=None):
+        self._root = root and os.path.abspath(root)
+        self._lock = threading.RLock()
+        self._refs = {} # ref name -> ((inode, mtime, size) of ref file, ref file content)
+        self._objects = OrderedDict() # oid -> (type, content), least recently used first
+        self._objects_size = 0
+        self._object_dirs = set() # object subdirectories known to exist
 
-def get_ref(ref, deref=True):
+    @property
+    def root(self):
+        return self._root or os.getcwd()
+
+    @property
+    def git_dir(self):
+        return os.path.join(self.root, GIT_DIR)
+
+    @property
+    def objects_dir(self):
+        return os.path.join(self.git_dir, 'objects')
+
+    @property
+    def cached(self):
+        return self._root is not None
+
+    def refresh(self):
+        """
+        Drop all cached refs and objects
+        """
+        with self._lock:
+            self._refs.clear()
+            self._objects.clear()
+            self._objects_size = 0
+            self._object_dirs.clear()
+
+    def init(self):
+        """
+        Init .ugit repository
+        """
+        git_dir = os.path.abspath(self.git_dir)
+        if os.path.exists(self.git_dir):
+            # we do not really reinitialize git repository here
+            print('Reinitialized existing Git repository in %s' % git_dir)
+        else:
+            os.makedirs(self.git_dir)
+            os.makedirs(self.objects_dir)
+            print('Initialized empty ugit repository in %s' % git_dir)
+
+    def update_ref(self, ref, value, deref=True):
+        """
+        Create or update a ref in .ugit/<ref>
+        """
+        with self._lock:
+            # dereference ref if ref is a symbolic ref, we only update the real ref
+            ref = self._get_ref_internal(ref, deref)[0]
+            if not value.value:
+                raise TypeError('RefValue is empty: "{0}"'.format(value))
+            if value.symbolic:
+                # set value of a symbolic ref as 'ref: <pointed ref>'
+                value = 'ref: {0}'.format(value.value)
+            else:
+                value = value.value
+
+            ref_path = os.path.join(self.git_dir, ref)
+            os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+            self._write_file(ref_path, value.encode())
+
+    def get_ref(self, ref, deref=True):
+        """
+        Read file content in .ugit/<ref>
+        """
+        return self._get_ref_internal(ref, deref)[1]
+
+    def delete_ref(self, ref, deref=True):
+        """
+        Remove an existing ref
+        """
+        with self._lock:
+            ref = self._get_ref_internal(ref, deref)[0]
+            os.remove(os.path.join(self.git_dir, ref))
+            self._refs.pop(ref, None)
+
+    def _read_ref(self, ref):
+        """
+        Return content of ref file, read from disk only if the file changed since the last read
+        """
+        try:
+            ref_stat = os.stat(os.path.join(self.git_dir, ref))
+        except OSError:
+            return None
+        if not stat.S_ISREG(ref_stat.st_mode):
+            return None
+        # refs are replaced by a new file on update, so a changed ref always has a different key
+        key = (ref_stat.st_ino, ref_stat.st_mtime_ns, ref_stat.st_size)
+        with self._lock:
+            if ref in self._refs and self._refs[ref][0] == key:
+                return self._refs[ref][1]
+        with open(os.path.join(self.git_dir, ref)) as f:
+            value = f.read().strip()
+        if self.cached:
+            with self._lock:
+                self._refs[ref] = (key, value)
+        return value
+
+    def _get_ref_internal(self, ref, deref):
+        """
+        If input is a symbolic ref, return the last ref pointed by it
+        """
+        value = self._read_ref(ref)
+        symbolic = bool(value) and value.startswith('ref:')
+        if symbolic:
+            # if this ref is a symbolic ref, dereference it recursively
+            value = value.split(':', 1)[1].strip()
+            if deref:
+                return self._get_ref_internal(value, deref=True)
+        # return ref name, ref value
+        return ref, RefValue(symbolic=symbolic, value=value)
+
+    def iter_refs(self, prefix='', deref=True):
+        """
+        Iterate all refs in .ugit/refs and 'HEAD'
+        """
+        refs = ['HEAD', 'Merged_HEAD']
+        for root, _, file_names in os.walk(os.path.join(self.git_dir, 'refs')):
+            root = os.path.relpath(root, self.git_dir)
+            refs.extend(os.path.join(root, name) for name in file_names)
+        for ref_name in refs:
+            # only return refs starting with prefix
+            if ref_name.startswith(prefix):
+                ref = self.get_ref(ref_name, deref=deref)
+                if ref.value:
+                    yield ref_name, ref
+
+    def hash_object(self, data, type='blob'):
+        """
+        Store object to a file named with its hash value(OID) in bytes
+        Parameters: type: 'blob': the default type, just a collections of bytes without any semantic meaning
+        Note: large blobs are stored as a 'chunked' manifest listing the oids of their chunks.
+        The manifest has the oid of the whole content, so oids do not depend on how a blob is stored.
+        """
+        if type == 'blob' and CHUNK_THRESHOLD is not None and len(data) > CHUNK_THRESHOLD:
+            oid = hashlib.sha1(data).hexdigest()
+            if self._touch_object(oid):
+                # already stored, maybe as a plain blob by an older version
+                return oid
+            # chunks are stored as plain blobs, so identical chunks are shared by all revisions
+            manifest = ''.join(f'{self._write_object(chunk, "blob")}\n' for chunk in _iter_chunks(data))
+            return self._write_object(manifest.encode(), 'chunked', oid)
+        return self._write_object(data, type)
+
+    def _touch_object(self, oid):
+        """
+        Return True if object exists, and refresh its mtime so gc keeps it
+        """
+        try:
+            os.utime(os.path.join(self.objects_dir, oid[:2], oid[2:]))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _write_object(self, data, type, oid=None):
+        """
+        Write object to .ugit/objects and return its oid (hash of data unless given)
+        """
+        obj = type.encode() + b'\x00' + data # type + null byte + data
+        oid = oid or hashlib.sha1(data).hexdigest() # hash object and convert to binary presentation
+        # objects never change, an existing object is not written again
+        if self._touch_object(oid):
+            return oid
+        # store the object to the folder named with the top two characters of its hash value
+        dirs = os.path.join(self.objects_dir, oid[:2])
+        path = os.path.join(dirs, oid[2:])
+        if dirs not in self._object_dirs:
+            os.makedirs(dirs, exist_ok=True)
+            if self.cached:
+                self._object_dirs.add(dirs)
+        try:
+            self._write_file(path, obj)
+        except FileNotFoundError:
+            # directory was removed by another process, create it again
+            os.makedirs(dirs, exist_ok=True)
+            self._write_file(path, obj)
+        return oid
+
+    def _write_file(self, path, content):
+        """
+        Write content to a temporary file and move it to path, so readers never see a partial file
+        """
+        # temporary files are in .ugit, so they are never listed as refs or objects
+        tmp_path = os.path.join(self.git_dir, 'tmp_{0}'.format(uuid.uuid4().hex))
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666) # file mode follows umask, as open() does
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _read_object(self, oid):
+        """
+        Return (type, content) of object, small objects are kept in memory
+        """
+        with self._lock:
+            if oid in self._objects:
+                self._objects.move_to_end(oid)
+                return self._objects[oid]
+        with open(os.path.join(self.objects_dir, oid[:2], oid[2:]), 'rb') as f:
+            obj = f.read()
+        obj_type, sep, content = obj.partition(b'\x00') # separate via a null byte
+        if not sep:
+            raise ValueError("object {0} is corrupted".format(oid))
+        obj = (obj_type.decode(), content)
+        if self.cached and len(content) <= OBJECT_CACHE_MAX_ITEM:
+            with self._lock:
+                if oid not in self._objects:
+                    self._objects[oid] = obj
+                    self._objects_size += len(content)
+                # evict least recently used objects
+                while self._objects_size > OBJECT_CACHE_SIZE:
+                    _, (_, evicted) = self._objects.popitem(last=False)
+                    self._objects_size -= len(evicted)
+        return obj
+
+    def get_object(self, oid, expected='blob'):
+        """
+        Print object content named by its hash value(OID)
+        Parameters: oid: hash value of object; expected: expected object type
+        Note: a 'chunked' object is reassembled and returned as a blob unless expected='chunked'.
+        """
+        obj_type, content = self._read_object(oid)
+        if obj_type == 'chunked' and expected != 'chunked':
+            content = b''.join(self.get_object(chunk) for chunk in content.decode().split())
+            obj_type = 'blob'
+        if expected is not None and obj_type != expected:
+            raise ValueError("object type is {0}, expected {1}".format(obj_type, expected))
+        return content
+
+    def get_object_type(self, oid):
+        """
+        Return type of object without reading its content
+        """
+        with self._lock:
+            if oid in self._objects:
+                return self._objects[oid][0]
+        with open(os.path.join(self.objects_dir, oid[:2], oid[2:]), 'rb') as f:
+            header = f.read(16) # object types are shorter than 16 bytes
+        return header.partition(b'\x00')[0].decode()
+
+    def iter_objects(self):
+        """
+        Iterate (oid, os.stat_result) of all objects in .ugit/objects
+        """
+        with os.scandir(self.objects_dir) as dirs:
+            for d in dirs:
+                if not d.is_dir() or len(d.name) != 2:
+                    continue
+                with os.scandir(d.path) as it:
+                    for entry in it:
+                        yield d.name + entry.name, entry.stat()
+
+    def delete_object(self, oid, deadline=None):
+        """
+        Remove an object, unless it was modified after deadline (a timestamp); return its size if removed, else None
+        Note: its directory is kept even if empty, other repositories on the same path may be writing to it.
+        """
+        path = os.path.join(self.objects_dir, oid[:2], oid[2:])
+        with self._lock:
+            try:
+                # stat right before removing: hashing an existing object again only refreshes its mtime
+                object_stat = os.stat(path)
+            except FileNotFoundError:
+                return None
+            if deadline is not None and object_stat.st_mtime > deadline:
+                return None
+            os.remove(path)
+            if oid in self._objects:
+                self._objects_size -= len(self._objects.pop(oid)[1])
+            return object_stat.st_size
+
+_default_repository = Repository()
+_local = threading.local()
+_repositories = {} # absolute root -> Repository
+_repositories_lock = threading.Lock()
+
+def open_repository(root):
     """
-    Read file content in .ugit/<ref>
+    Return the shared repository at root, so all threads of a process use the same caches
     """
-    return _get_ref_internal(ref, deref)[1]
+    root = os.path.abspath(root)
+    with _repositories_lock:
+        if root not in _repositories:
+            _repositories[root] = Repository(root)
+        return _repositories[root]
 
-def delete_ref(ref, deref=True):
+def get_repository():
     """
-    Remove an existing ref
+    Return repository used by the module functions in this thread (the current directory by default)
     """
-    ref = _get_ref_internal(ref, deref)[0]
-    os.remove(os.path.join(GIT_DIR, ref))
+    return getattr(_local, 'repository', None) or _default_repository
 
-def _get_ref_internal(ref, deref):
+@contextmanager
+def use_repository(repository):
     """
-    If input is a symbolic ref, return the last ref pointed by it
+    Run module functions of data and base on repository within this block, in this thread only
     """
-    ref_path = os.path.join(GIT_DIR, ref)
-    if os.path.isfile(ref_path):
-        with open(ref_path) as f:
-            value = f.read().strip()
-    else:
-        value = None
-    symbolic = bool(value) and value.startswith('ref:')
-    if symbolic:
-        # if this ref is a symbolic ref, dereference it recursively
-        value = value.split(':', 1)[1].strip()
-        if deref:
-            return _get_ref_internal(value, deref=True)
-    # return ref name, ref value
-    return ref, RefValue(symbolic=symbolic, value=value)
+    previous = getattr(_local, 'repository', None)
+    _local.repository = repository
+    try:
+        yield repository
+    finally:
+        _local.repository = previous
+
+def init():
+    return get_repository().init()
+
+def update_ref(ref, value, deref=True):
+    return get_repository().update_ref(ref, value, deref)
+
+def get_ref(ref, deref=True):
+    return get_repository().get_ref(ref, deref)
+
+def delete_ref(ref, deref=True):
+    return get_repository().delete_ref(ref, deref)
 
 def iter_refs(prefix='', deref=True):
-    """
-    Iterate all refs in .ugit/refs and 'HEAD'
-    """
-    refs = ['HEAD', 'Merged_HEAD']
-    for root, _, file_names in os.walk(os.path.join(GIT_DIR, 'refs')):
-        root = os.path.relpath(root, GIT_DIR)
-        refs.extend(os.path.join(root, name) for name in file_names)
-    for ref_name in refs:
-        # only return refs starting with prefix
-        if ref_name.startswith(prefix):
-            ref = get_ref(ref_name, deref=deref)
-            if ref.value:
-                yield ref_name, ref
+    return get_repository().iter_refs(prefix, deref)
 
 def hash_object(data, type='blob'):
+    return get_repository().hash_object(data, type)
+
+def get_object(oid, expected='blob'):
+    return get_repository().get_object(oid, expected)
+
+def get_object_type(oid):
+    return get_repository().get_object_type(oid)
+
+def iter_objects():
+    return get_repository().iter_objects()
+
+def delete_object(oid, deadline=None):
+    return get_repository().delete_object(oid, deadline)
+
+def _iter_boundaries(data):
     """
-    Store object to a file named with its hash value(OID) in bytes
-    Parameters: type: 'blob': the default type, just a collections of bytes without any semantic meaning
+    Iterate positions where a chunk may end, about 1 in 64KB of data.
+    A position is a candidate if a rolling hash of the few bytes before it is zero, and a boundary if
+    the checksum of the CHUNK_WINDOW bytes before it matches CHUNK_MASK. Both only depend on the bytes
+    right before the position, so an edit only changes the boundaries around it.
+    Note: the rolling hash of a whole block is computed with a few big integer operations, so python code
+    only runs once per candidate (about 1 in 256 bytes) instead of once per byte.
     """
-    obj = type.encode() + b'\x00' + data # type + null byte + data
-    oid = hashlib.sha1(data).hexdigest() # hash object and convert to binary presentation
-    # store the object to the folder named with the top two characters of its hash value
-    dirs = os.path.join(os.getcwd(), GIT_DIR, 'objects', oid[:2])
-    os.makedirs(dirs, exist_ok=True)
-    with open(os.path.join(dirs, oid[2:]), 'wb') as out:
-        out.write(obj)
-    return oid
+    skip_to = 0
+    for block in range(0, len(data), _CHUNK_BLOCK):
+        lo = max(block - 8, 0) # hash of a position depends on the 4 bytes before it
+        values = data[lo:block + _CHUNK_BLOCK].translate(_CHUNK_TABLE)
+        x = int.from_bytes(values, 'little')
+        # byte k of h mixes the table values of bytes k-4..k; shifts are not multiples of 8, so runs of a byte are rarely zero
+        h = (x ^ (x << 9) ^ (x << 18) ^ (x << 27)).to_bytes(len(values) + 4, 'little')
+        end = len(values)
+        i = h.find(0, block - lo, end)
+        while i != -1:
+            position = lo + i + 1
+            if position >= max(CHUNK_WINDOW, skip_to):
+                window = data[position - CHUNK_WINDOW:position]
+                if not zlib.crc32(window) & CHUNK_MASK:
+                    yield position
+                if window == window[-1:] * CHUNK_WINDOW:
+                    # a run of the same byte is a single candidate
+                    skip_to = _CHUNK_RUN.match(data, position - 1).end()
+            i = h.find(0, i + 1, end)
 
-def get_object(oid, expected='blob'):
+def _iter_chunks(data):
     """
-    Print object content named by its hash value(OID)
-    Parameters: oid: hash value of object; expected: expected object type
+    Split data into content-defined chunks between CHUNK_MIN_SIZE and CHUNK_MAX_SIZE bytes.
     """
-    with open(os.path.join(os.getcwd(), GIT_DIR, 'objects', oid[:2], oid[2:]), 'rb') as f:
-        obj = f.read()
-    obj_type, _, content = obj.partition(b'\x00') # separate via a null byte
-    obj_type = obj_type.decode()
-    
-    if expected is not None and obj_type != expected:
-        raise ValueError("object type is {0}, expected {1}".format(obj_type, expected))
-    return content
+    start, size = 0, len(data)
+    for cut in itertools.chain(_iter_boundaries(data), [size]):
+        while cut - start > CHUNK_MAX_SIZE:
+            yield data[start:start + CHUNK_MAX_SIZE]
+            start += CHUNK_MAX_SIZE
+        if cut - start >= CHUNK_MIN_SIZE or (cut == size and start < size):
+            yield data[start:cut]
+            start = cut